@@ -1,31 +1,79 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory, url_for
-from yt_dlp import YoutubeDL
 import os
+
+# gevent debe parchear sockets/hilos antes de importar yt-dlp, Flask, etc.
+if os.getenv("USE_GEVENT"):
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, Response, abort, request, jsonify, render_template, send_from_directory, url_for
+from flask.json.provider import JSONProvider
+from werkzeug.utils import safe_join
+from cachetools import TTLCache
+import orjson
+from pydantic import BaseModel, Field, HttpUrl, ValidationError, field_validator
+import itertools
+import mimetypes
 import re
+import shutil
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from queue import Queue, Full
+from urllib.parse import quote
+from uuid import uuid4
 from pathlib import Path
-from typing import Optional, Dict, Any, List
+from typing import TYPE_CHECKING, Optional, Dict, Any, List, Iterator, Callable
+
+if TYPE_CHECKING:
+    from yt_dlp import YoutubeDL
+
+class ORJSONProvider(JSONProvider):
+    """Serializa las respuestas de jsonify con orjson (mucho más rápido que json)."""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s: Any, **kwargs: Any) -> Any:
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 
 # === Config ===
 DOWNLOAD_FOLDER = os.getenv("DOWNLOAD_FOLDER", "./downloads")
 DOWNLOAD_DIR = Path(DOWNLOAD_FOLDER).resolve()
 DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
+# En producción los archivos los entrega nginx (location interna X_ACCEL_PREFIX -> DOWNLOAD_DIR)
+USE_X_ACCEL = os.getenv("ENV") == "production"
+X_ACCEL_PREFIX = os.getenv("X_ACCEL_PREFIX", "/_protected/")
+FILES_MAX_AGE = int(os.getenv("FILES_MAX_AGE", "3600"))
+
 # Extensiones de audio que aceptaremos (sin conversión FFmpeg)
-AUDIO_EXTS = {"m4a", "webm", "opus", "mp4", "m4b", "mp3"}
+AUDIO_EXTS = frozenset({"m4a", "webm", "opus", "mp4", "m4b", "mp3"})
+_DOT_EXTS = frozenset("." + x for x in AUDIO_EXTS)  # para comparar el sufijo sin lstrip
+
+# Caché de metadatos (extract_info) por URL: evita repetir red + JS en preview -> descarga.
+# Guarda (info, proxy): las URLs de stream van ligadas a la IP que extrajo la info.
+INFO_CACHE_SIZE = int(os.getenv("INFO_CACHE_SIZE", "512"))
+INFO_CACHE_TTL = int(os.getenv("INFO_CACHE_TTL", "300"))
+_info_cache: TTLCache = TTLCache(maxsize=INFO_CACHE_SIZE, ttl=INFO_CACHE_TTL)
+_info_lock = threading.Lock()
 
 # --- Utilidades ---
 INVALID_WIN_CHARS = r'<>:"/\\|?*\0'
+_INVALID_RE = re.compile(f"[{re.escape(INVALID_WIN_CHARS)}]")
+RESERVED_WIN_NAMES = frozenset({
+    "CON","PRN","AUX","NUL","COM1","COM2","COM3","COM4","COM5",
+    "COM6","COM7","COM8","COM9","LPT1","LPT2","LPT3","LPT4",
+    "LPT5","LPT6","LPT7","LPT8","LPT9"
+})
+
 def sanitize_filename(name: str) -> str:
-    cleaned = re.sub(f"[{re.escape(INVALID_WIN_CHARS)}]", "_", name)
+    cleaned = _INVALID_RE.sub("_", name)
     cleaned = cleaned.strip().rstrip(". ")
-    reserved = {
-        "CON","PRN","AUX","NUL","COM1","COM2","COM3","COM4","COM5",
-        "COM6","COM7","COM8","COM9","LPT1","LPT2","LPT3","LPT4",
-        "LPT5","LPT6","LPT7","LPT8","LPT9"
-    }
-    if cleaned.upper() in reserved:
+    if cleaned.upper() in RESERVED_WIN_NAMES:
         cleaned = f"_{cleaned}"
     return cleaned or "audio"
 
@@ -35,35 +83,371 @@ def pick_best_audio(formats: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
     """
     if not formats:
         return None
-    audios = [f for f in formats if (f.get("vcodec") in (None, "none"))]
-    if not audios:
-        return None
 
-    def score(f: Dict[str, Any]) -> tuple:
+    # Una sola pasada (min) en vez de ordenar toda la lista para tomar el primero
+    best = None
+    best_key = None
+    for f in formats:
+        if f.get("vcodec") not in (None, "none"):
+            continue
         ext = (f.get("ext") or "").lower()
         acodec = (f.get("acodec") or "").lower()
-        abr = f.get("abr") or 0
         if ext == "m4a" or acodec.startswith("mp4a") or "aac" in acodec:
             priority = 0
         elif ext in ("webm", "opus") or "opus" in acodec:
             priority = 1
         else:
             priority = 2
-        return (priority, -abr)
+        key = (priority, -(f.get("abr") or 0))
+        if best_key is None or key < best_key:
+            best, best_key = f, key
+    return best
 
-    audios.sort(key=score)
-    return audios[0]
+def _iter_audio(root: Path) -> Iterator[os.DirEntry]:
+    """Recorre el árbol con os.scandir (pila explícita) y produce los archivos de audio."""
+    stack = [str(root)]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    stack.append(e.path)
+                    continue
+                name = e.name
+                dot = name.rfind(".")
+                if dot >= 0 and name[dot:].lower() in _DOT_EXTS and e.is_file(follow_symlinks=False):
+                    yield e
 
-def find_audio_file(safe_title: str) -> Optional[Path]:
-    """Busca recursivamente archivos de audio cuyo nombre empiece con el título saneado."""
-    candidates = [
-        p for p in DOWNLOAD_DIR.rglob(f"{safe_title}.*")
-        if p.is_file() and p.suffix.lstrip(".").lower() in AUDIO_EXTS
-    ]
+def find_audio_file(safe_title: str, ext: Optional[str] = None) -> Optional[Path]:
+    """
+    Busca recursivamente archivos de audio cuyo nombre empiece con el título saneado.
+    Si aparece exactamente "<título>.<ext>" se devuelve sin seguir recorriendo.
+    """
+    prefix = safe_title + "."
+    exact = f"{prefix}{ext}" if ext else None
+    candidates = []
+    for e in _iter_audio(DOWNLOAD_DIR):
+        name = e.name
+        if name == exact:
+            return Path(e.path)
+        if name.startswith(prefix):
+            candidates.append((e.path, e.stat().st_mtime))
     if not candidates:
         return None
-    candidates.sort(key=lambda p: p.stat().st_mtime, reverse=True)
-    return candidates[0]
+    return Path(max(candidates, key=lambda t: t[1])[0])
+
+# Red compartida por metadatos y descarga. Con "requests" instalado, yt-dlp mantiene un
+# pool de conexiones keep-alive dentro de cada instancia de YoutubeDL del pool (abajo).
+NET_OPTS: Dict[str, Any] = {
+    "socket_timeout": int(os.getenv("SOCKET_TIMEOUT", "30")),
+}
+# Opcional: aria2c descarga el archivo por rangos en paralelo (yt-dlp ya le pasa -x16 -s16;
+# aquí solo se reduce el tamaño mínimo de rango). Limitación en yt-dlp 2023.12.30: con
+# aria2c no se emiten avisos de progreso "downloading", así que /downloads/<id>/progress
+# queda vacío y una descarga ya iniciada no se puede abortar al vencer un lote (solo se
+# evita que empiecen las que aún esperaban turno).
+ARIA2C_OPTS: Dict[str, Any] = {}
+if os.getenv("USE_ARIA2C") and shutil.which("aria2c"):
+    ARIA2C_OPTS = {
+        "external_downloader": {"default": "aria2c"},
+        "external_downloader_args": {"aria2c": ["-k1M"]},
+    }
+
+INFO_OPTS = {
+    **NET_OPTS,
+    "noplaylist": True,
+    "ignoreconfig": True,   # evita configs externas (como --write-pages)
+    "quiet": True,
+    "no_warnings": True,
+    "skip_download": True,
+}
+
+# Pocas sesiones simultáneas contra YouTube desde la misma IP: más allá de eso salta el
+# "confirm you're not a bot" y afecta a todas las peticiones siguientes
+_YDL_SEM = threading.BoundedSemaphore(int(os.getenv("YDL_CONCURRENCY", "2")))
+YDL_WAIT_TIMEOUT = float(os.getenv("YDL_WAIT_TIMEOUT", "15"))
+
+# Proxies opcionales (YDL_PROXIES="http://a:8080,socks5://b:1080"), uno por URL en
+# rotación; la descarga sale por el mismo proxy que extrajo la info (googlevideo liga
+# las URLs de stream a esa IP)
+_proxy_list = [p.strip() for p in os.getenv("YDL_PROXIES", "").split(",") if p.strip()]
+_proxies = itertools.cycle(_proxy_list) if _proxy_list else None
+_proxies_lock = threading.Lock()
+
+def _next_proxy() -> Optional[str]:
+    if _proxies is None:
+        return None
+    with _proxies_lock:
+        return next(_proxies)
+
+# Pool de instancias de YoutubeDL por proceso, por juego de opciones y proxy: evita reconstruir
+# extractores, cookies y adaptadores HTTP (con su keep-alive) en cada petición. Es una
+# lista con lock y no un threading.local porque con gevent cada petición es un greenlet
+# nuevo; las instancias que sobran al devolverse se cierran.
+YDL_POOL_MAX_IDLE = int(os.getenv("YDL_POOL_MAX_IDLE", "4"))
+_ydl_pool: Dict[tuple, List["YoutubeDL"]] = {}
+_ydl_pool_lock = threading.Lock()
+
+# Callback de progreso de la descarga en curso. Es local al hilo (o greenlet) que llama a
+# yt-dlp, que es el mismo en el que yt-dlp ejecuta el hook.
+_tls = threading.local()
+
+@contextmanager
+def pooled_ydl(
+    opts_sig: str, opts: Dict[str, Any], proxy: Optional[str] = None
+) -> Iterator["YoutubeDL"]:
+    # yt-dlp carga cientos de extractores: se importa aquí, en el primer uso, y no al
+    # arrancar el worker (/, /files y /files/<nombre> nunca lo necesitan)
+    from yt_dlp import YoutubeDL
+
+    key = (opts_sig, proxy)
+    with _ydl_pool_lock:
+        idle = _ydl_pool.setdefault(key, [])
+        ydl = idle.pop() if idle else None
+    if ydl is None:
+        extra: Dict[str, Any] = {"progress_hooks": [_progress_hook]}
+        if proxy:
+            extra["proxy"] = proxy
+        ydl = YoutubeDL({**opts, **extra})
+    try:
+        yield ydl
+    finally:
+        with _ydl_pool_lock:
+            idle = _ydl_pool[key]
+            if len(idle) < YDL_POOL_MAX_IDLE:
+                idle.append(ydl)
+                ydl = None
+        if ydl is not None:
+            ydl.close()
+
+def _progress_hook(d: Dict[str, Any]) -> None:
+    """
+    Reenvía el progreso de yt-dlp al callback de la descarga en curso de este hilo y la
+    aborta (DownloadCancelled) si su evento de cancelación está activo.
+    """
+    if d.get("tmpfilename"):
+        _tls.tmpfile = d["tmpfilename"]
+    cancelled = getattr(_tls, "cancelled", None)
+    if cancelled is not None and cancelled.is_set():
+        from yt_dlp.utils import DownloadCancelled
+        raise DownloadCancelled()
+    cb = getattr(_tls, "on_progress", None)
+    if cb is None or d.get("status") != "downloading":
+        return
+    total = d.get("total_bytes") or d.get("total_bytes_estimate")
+    downloaded = d.get("downloaded_bytes") or 0
+    cb({
+        "downloaded": downloaded,
+        "total": total,
+        "speed": d.get("speed"),
+        "progress": downloaded / total if total else None,
+    })
+
+class BusyError(Exception):
+    """No hubo turno libre de yt-dlp a tiempo (todas las sesiones están ocupadas)."""
+
+def get_info(url: str) -> Optional[Dict[str, Any]]:
+    """Devuelve la info de yt-dlp (sin descargar) usando la caché TTL por URL."""
+    with _info_lock:
+        cached = _info_cache.get(url)
+    if cached is not None:
+        return cached[0]
+    # Las descargas pueden retener el semáforo minutos: la vista previa espera poco y
+    # devuelve "ocupado" en vez de quedarse colgada con la conexión abierta
+    if not _YDL_SEM.acquire(timeout=YDL_WAIT_TIMEOUT):
+        raise BusyError("Servidor ocupado con otras descargas, intenta de nuevo en unos segundos.")
+    proxy = _next_proxy()
+    try:
+        with pooled_ydl("info", INFO_OPTS, proxy) as ydl:
+            info = ydl.extract_info(url, download=False)
+    finally:
+        _YDL_SEM.release()
+    if info:
+        with _info_lock:
+            _info_cache[url] = (info, proxy)
+    return info
+
+class DownloadError(Exception):
+    """Error esperado durante una descarga (mensaje apto para el cliente)."""
+
+# Misma prioridad que pick_best_audio (M4A/AAC, luego WebM/Opus, luego cualquiera),
+# pero resuelta por yt-dlp dentro de la extracción
+AUDIO_FORMAT = "bestaudio[ext=m4a]/bestaudio[acodec^=mp4a]/bestaudio[ext=webm]/bestaudio"
+
+DOWNLOAD_OPTS = {
+    **NET_OPTS,
+    **ARIA2C_OPTS,
+    "format": AUDIO_FORMAT,
+    "noplaylist": True,
+    "write_pages": False,
+    "ignoreconfig": True,   # ignora config global de yt-dlp
+    "quiet": True,
+    "no_warnings": True,
+    "ignoreerrors": True,
+    "windowsfilenames": True,
+    "outtmpl": str(DOWNLOAD_DIR / "%(title)s.%(ext)s"),  # ruta absoluta
+    "overwrites": True,
+    "rm_cache_dir": True,
+}
+
+def _remove_partial(path: Optional[str]) -> None:
+    if path and path.endswith(".part"):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+def download_one(
+    video_url: str,
+    on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+    cancelled: Optional[threading.Event] = None,
+) -> Dict[str, Any]:
+    """
+    Descarga el mejor audio de una URL (AUDIO_FORMAT, guarda sin convertir).
+    Si se pasa on_progress, recibe {downloaded, total, speed, progress} mientras descarga.
+    Si se activa cancelled, no se empieza (o se aborta) la descarga y se borra el .part.
+    """
+    from yt_dlp.utils import DownloadCancelled
+
+    with _info_lock:
+        cached = _info_cache.get(video_url)
+    # Con info en caché se descarga por el mismo proxy que la extrajo
+    info, proxy = cached if cached is not None else (None, _next_proxy())
+
+    _tls.on_progress = on_progress
+    _tls.cancelled = cancelled
+    _tls.tmpfile = None
+    try:
+        with _YDL_SEM, pooled_ydl("download", DOWNLOAD_OPTS, proxy) as ydl:
+            # Pudo cancelarse mientras esperaba turno: no tocar yt-dlp en ese caso
+            if cancelled is not None and cancelled.is_set():
+                raise DownloadError("Tiempo de descarga agotado")
+            if info is not None:
+                # Hubo preview: se reutiliza la info, como copia saneada (sin requested_formats
+                # de la selección por defecto, que forzaría video+audio). sanitize_info hace
+                # setdefault sobre lo que recibe: se le pasa una copia para no tocar la caché.
+                result = ydl.process_ie_result(
+                    ydl.sanitize_info(dict(info), remove_private_keys=True), download=True
+                )
+            else:
+                # Una sola llamada: yt-dlp extrae, elige formato con AUDIO_FORMAT y descarga
+                result = ydl.extract_info(video_url, download=True)
+            expected = ydl.prepare_filename(result) if result else None
+    except DownloadCancelled:
+        _remove_partial(_tls.tmpfile)
+        raise DownloadError("Tiempo de descarga agotado")
+    finally:
+        _tls.on_progress = None
+        _tls.cancelled = None
+    if not result:
+        raise DownloadError(
+            "No se pudo descargar el audio (sin información o sin pista de audio; "
+            "puede requerir login/cookies)."
+        )
+
+    title = result.get("title") or "audio"
+    ext = (result.get("ext") or "").lower() or "m4a"
+    safe_title = sanitize_filename(title)
+
+    # Ruta final: la informa yt-dlp; el nombre esperado y la búsqueda quedan de respaldo
+    downloads = result.get("requested_downloads") or []
+    filepath = (downloads[0].get("filepath") if downloads else None) or result.get("filepath")
+    final_path = Path(filepath or expected)
+    if not final_path.exists():
+        final_path = find_audio_file(safe_title, ext)
+
+    # Limpieza de posibles .mhtml
+    mhtml = DOWNLOAD_DIR / f"{safe_title}.mhtml"
+    if mhtml.exists():
+        try:
+            mhtml.unlink()
+        except Exception:
+            pass
+
+    if not final_path or not final_path.exists():
+        raise DownloadError("No se generó el archivo de audio.")
+
+    return {"title": title, "filename": final_path.name}
+
+# --- Cola de descargas ---
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "32"))
+JOB_TTL = int(os.getenv("JOB_TTL", "3600"))
+
+# Estado por job_id; caduca para no crecer sin límite en un servidor de larga vida
+jobs: TTLCache = TTLCache(maxsize=4096, ttl=JOB_TTL)
+_jobs_lock = threading.Lock()
+_job_queue: "Queue[tuple]" = Queue(maxsize=JOB_QUEUE_SIZE)
+
+def _set_job(jid: str, **fields: Any) -> None:
+    with _jobs_lock:
+        jobs[jid] = {**jobs.get(jid, {}), **fields}
+
+def _worker() -> None:
+    while True:
+        jid, video_url = _job_queue.get()
+        _set_job(jid, status="running")
+        try:
+            result = download_one(video_url, lambda p, jid=jid: _set_job(jid, **p))
+            _set_job(jid, status="done", **result)
+        except DownloadError as e:
+            _set_job(jid, status="error", error=str(e))
+        except Exception as e:
+            _set_job(jid, status="error", error=f"Error descargando: {str(e)}")
+        finally:
+            _job_queue.task_done()
+
+for _ in range(JOB_WORKERS):
+    threading.Thread(target=_worker, daemon=True).start()
+
+# Pool acotado para lotes: yt-dlp es I/O de red, pero pocas sesiones simultáneas evitan el anti-bot
+DL_WORKERS = int(os.getenv("DL_WORKERS", "4"))
+BATCH_MAX_URLS = int(os.getenv("BATCH_MAX_URLS", "20"))
+BATCH_TIMEOUT = int(os.getenv("BATCH_TIMEOUT", "600"))
+_pool = ThreadPoolExecutor(max_workers=DL_WORKERS)
+
+# --- Esquemas de entrada (pydantic valida URL y tipos en el borde) ---
+class _UrlIn(BaseModel):
+    @field_validator("url", "urls", mode="before", check_fields=False)
+    @classmethod
+    def _strip(cls, v: Any) -> Any:
+        if isinstance(v, str):
+            return v.strip()
+        if isinstance(v, list):
+            return [x.strip() if isinstance(x, str) else x for x in v]
+        return v
+
+class UrlRequest(_UrlIn):
+    url: HttpUrl
+
+class BatchRequest(_UrlIn):
+    urls: List[HttpUrl] = Field(min_length=1, max_length=BATCH_MAX_URLS)
+
+def _error_message(err: Dict[str, Any]) -> str:
+    """Mensaje para el cliente según el tipo de error de pydantic."""
+    kind = err["type"]
+    field = err["loc"][0] if err["loc"] else None
+    if kind in ("model_type", "model_attributes_type"):
+        return "Request body must be a JSON object"
+    if kind == "missing":
+        return f"{field} is required"
+    if kind == "list_type":
+        return f"{field} must be a list"
+    if kind == "too_short":
+        return f"{field} must contain at least one URL"
+    if kind == "too_long":
+        return f"Máximo {BATCH_MAX_URLS} URLs por lote"
+    if kind.startswith("url_") or kind == "string_type":
+        return "Invalid URL format"
+    return err["msg"]
+
+def _invalid_request(e: ValidationError):
+    errors = e.errors(include_url=False, include_context=False)
+    details = [{"loc": list(err["loc"]), "msg": err["msg"]} for err in errors]
+    return jsonify({"error": _error_message(errors[0]), "details": details}), 400
 
 # --- Rutas ---
 @app.route("/")
@@ -73,19 +457,12 @@ def home():
 # Vista previa (sin descargar)
 @app.route("/preview", methods=["POST"])
 def preview():
-    data = request.get_json(silent=True) or {}
-    video_url = (data.get("url") or "").strip()
-    if not re.match(r"^https?://", video_url):
-        return jsonify({"error": "Invalid URL"}), 400
     try:
-        with YoutubeDL({
-            "noplaylist": True,
-            "ignoreconfig": True,   # evita configs externas (como --write-pages)
-            "quiet": True,
-            "no_warnings": True,
-            "skip_download": True,
-        }) as ydl:
-            info = ydl.extract_info(video_url, download=False)
+        video_url = str(UrlRequest.model_validate(request.get_json(silent=True) or {}).url)
+    except ValidationError as e:
+        return _invalid_request(e)
+    try:
+        info = get_info(video_url)
         if not info:
             return jsonify({"error": "No se pudo obtener información"}), 500
 
@@ -103,90 +480,136 @@ def preview():
                 "acodec": best.get("acodec") if best else None,
             }
         })
+    except BusyError as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "5"}
     except Exception as e:
         return jsonify({"error": f"Error en preview: {str(e)}"}), 500
 
-# Descargar (elige formato exacto y guarda sin convertir)
+# Descargar en segundo plano: responde 202 con un job_id y se consulta en /jobs/<id>
 @app.route("/downloads", methods=["POST"])
 def download_audio():
     data = request.get_json(silent=True) or {}
-    video_url = (data.get("url") or "").strip()
-
-    if not video_url:
-        return jsonify({"error": "URL is required"}), 400
-    if not re.match(r"^https?://", video_url):
-        return jsonify({"error": "Invalid URL format"}), 400
-
-    base_opts = {
-        "noplaylist": True,
-        "write_pages": False,
-        "ignoreconfig": True,   # ignora config global de yt-dlp
-        "quiet": True,
-        "no_warnings": True,
-        "ignoreerrors": True,
-        "windowsfilenames": True,
-        "outtmpl": str(DOWNLOAD_DIR / "%(title)s.%(ext)s"),  # ruta absoluta
-        "overwrites": True,
-        "rm_cache_dir": True,
-    }
-
     try:
-        # 1) Info previa para elegir formato
-        with YoutubeDL({**base_opts, "skip_download": True}) as ydl:
-            info = ydl.extract_info(video_url, download=False)
-        if not info:
-            return jsonify({"error": "No se pudo obtener información del video."}), 500
-
-        title = info.get("title") or "audio"
-        safe_title = sanitize_filename(title)
-        best = pick_best_audio(info.get("formats") or [])
-        if not best:
-            return jsonify({"error": "No hay pista de audio disponible (puede requerir login/cookies)."}), 500
+        video_url = str(UrlRequest.model_validate(data).url)
+    except ValidationError as e:
+        return _invalid_request(e)
 
-        fmt_id = best.get("format_id")
-        ext = (best.get("ext") or "").lower() or "m4a"
+    jid = uuid4().hex
+    with _jobs_lock:
+        jobs[jid] = {"status": "queued", "url": data["url"]}  # tal como la envió el cliente
+    try:
+        _job_queue.put_nowait((jid, video_url))
+    except Full:
+        with _jobs_lock:
+            jobs.pop(jid, None)
+        return jsonify({"error": "Demasiadas descargas en cola, intenta más tarde."}), 503
 
-        # 2) Descargar usando ese format_id exacto
-        with YoutubeDL({**base_opts, "format": fmt_id}) as ydl:
-            ydl.extract_info(video_url, download=True)
+    return jsonify({
+        "job_id": jid,
+        "status": "queued",
+        "job_url": url_for("job_status", jid=jid, _external=True),
+    }), 202
 
-        # 3) Localizar archivo final (exacto o por búsqueda)
-        exact = DOWNLOAD_DIR / f"{safe_title}.{ext}"
-        final_path = exact if exact.exists() else find_audio_file(safe_title)
+# Descarga varias URLs en paralelo (pool acotado) y devuelve un resultado por URL
+@app.route("/downloads/batch", methods=["POST"])
+def download_batch():
+    data = request.get_json(silent=True) or {}
+    try:
+        body = BatchRequest.model_validate(data)
+    except ValidationError as e:
+        return _invalid_request(e)
+    urls = [str(u) for u in body.urls]  # normalizadas, para descargar
+    sent = list(data["urls"])           # originales, para que el cliente empareje resultados
 
-        # Limpieza de posibles .mhtml
-        mhtml = DOWNLOAD_DIR / f"{safe_title}.mhtml"
-        if mhtml.exists():
-            try:
-                mhtml.unlink()
-            except Exception:
-                pass
+    # Plazo global para todo el lote; lo que no terminó se cancela: las pendientes no
+    # arrancan, las que esperan turno de yt-dlp lo sueltan sin extraer y las que ya
+    # descargan se abortan en el siguiente aviso de progreso (borrando su .part)
+    cancelled = threading.Event()
+    futures = [_pool.submit(download_one, u, None, cancelled) for u in urls]
+    done, pending = wait(futures, timeout=BATCH_TIMEOUT)
+    if pending:
+        cancelled.set()
+        for f in pending:
+            f.cancel()
 
-        if not final_path or not final_path.exists():
-            return jsonify({"error": "No se generó el archivo de audio."}), 500
+    results = []
+    for u, f in zip(sent, futures):
+        if f not in done:
+            results.append({"url": u, "status": "error", "error": "Tiempo de descarga agotado"})
+            continue
+        try:
+            r = f.result()
+            r["file_url"] = url_for("serve_file", filename=r["filename"], _external=True)
+            results.append({"url": u, "status": "done", **r})
+        except DownloadError as e:
+            results.append({"url": u, "status": "error", "error": str(e)})
+        except Exception as e:
+            results.append({"url": u, "status": "error", "error": f"Error descargando: {str(e)}"})
+    return jsonify({"results": results}), 200
 
-        file_url = url_for("serve_file", filename=final_path.name, _external=True)
-        return jsonify({
-            "title": title,
-            "filename": final_path.name,
-            "file_url": file_url,
-            "status": "Downloaded"
-        }), 200
+@app.route("/jobs/<jid>", methods=["GET"])
+def job_status(jid):
+    with _jobs_lock:
+        job = jobs.get(jid)
+        job = dict(job) if job else None
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    if job.get("filename"):
+        job["file_url"] = url_for("serve_file", filename=job["filename"], _external=True)
+    return jsonify({"job_id": jid, **job})
 
-    except Exception as e:
-        return jsonify({"error": f"Error descargando: {str(e)}"}), 500
+@app.route("/downloads/<jid>/progress", methods=["GET"])
+def job_progress(jid):
+    with _jobs_lock:
+        job = jobs.get(jid)
+        job = dict(job) if job else None
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify({
+        "job_id": jid,
+        "status": job.get("status"),
+        "downloaded": job.get("downloaded"),
+        "total": job.get("total"),
+        "speed": job.get("speed"),
+        "progress": job.get("progress"),
+    })
 
 @app.route("/files/<path:filename>")
 def serve_file(filename):
-    return send_from_directory(str(DOWNLOAD_DIR), filename, as_attachment=True)
+    path = safe_join(str(DOWNLOAD_DIR), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    if not USE_X_ACCEL:
+        # Rangos (206) para seeks del reproductor y 304 vía ETag barato (tamaño + mtime)
+        st = os.stat(path)
+        resp = send_from_directory(
+            str(DOWNLOAD_DIR), filename, as_attachment=True,
+            conditional=True, max_age=FILES_MAX_AGE,
+            etag=f"{st.st_size:x}-{st.st_mtime_ns:x}",
+        )
+        resp.headers["Accept-Ranges"] = "bytes"  # werkzeug solo lo envía en respuestas 206
+        return resp
+
+    # Producción: nginx sirve el archivo con sendfile(2) vía X-Accel-Redirect
+    name = os.path.basename(path)
+    resp = Response(mimetype=mimetypes.guess_type(name)[0] or "application/octet-stream")
+    resp.headers["X-Accel-Redirect"] = X_ACCEL_PREFIX + quote(filename)
+    try:
+        name.encode("ascii")
+        resp.headers["Content-Disposition"] = f'attachment; filename="{name}"'
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+        resp.headers["Content-Disposition"] = (
+            f'attachment; filename="{simple}"; filename*=UTF-8\'\'{quote(name)}'
+        )
+    return resp
 
 @app.route("/files", methods=["GET"])
 def list_files():
-    files = sorted(
-        [p.name for p in DOWNLOAD_DIR.rglob("*")
-         if p.is_file() and p.suffix.lstrip(".").lower() in AUDIO_EXTS]
-    )
+    files = sorted(e.name for e in _iter_audio(DOWNLOAD_DIR))
     return jsonify({"files": files})
 
+# Solo para desarrollo; en producción: gunicorn (ver Procfile)
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    app.run(host="0.0.0.0", port=5000, debug=False, threaded=True)